@@ -1,7 +1,7 @@
 #!/usr/bin/env -S uv run
 # /// script
 # requires-python = ">=3.8"
-# dependencies = []
+# dependencies = ["lxml", "urllib3"]
 # ///
 """
 Jellyfin IPTV EPG Generator
@@ -10,28 +10,48 @@ Filters playlist to only include channels with EPG data
 """
 
 import argparse
+import collections
+import hashlib
 import json
 import os
-import re
+import random
+import shutil
 import subprocess
 import sys
 import time
-import urllib.request
-import xml.etree.ElementTree as ET
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import urllib3
+from lxml import etree as ET
+
 URLS_FILE = "./urls"
 EPG_REPO = "https://github.com/iptv-org/epg.git"
+EPG_SPARSE_DIRS = ["sites", "scripts"]  # Cone-mode sparse dirs; top-level files (package.json etc.) always included
+NPM_LOCK_MARKER = ".installed-lock.sha256"  # package-lock.json hash of the last npm ci
 WORK_DIR = "./epg-workspace"
 OUTPUT_GUIDE = "./guide.xml"
 OUTPUT_PLAYLIST = "./playlist-filtered.m3u"
 CACHE_FILE = "./epg-workspace/channel-cache.json"
+CACHE_CHANNELS_FILE = "./epg-workspace/channel-cache.xml"
+CACHE_MATCHES_FILE = "./epg-workspace/channel-cache.ndjson"
 CACHE_MAX_AGE = 24 * 60 * 60  # 24 hours in seconds
 GUIDE_CACHE_MAX_AGE = 12 * 60 * 60  # 12 hours in seconds
+PLAYLIST_CACHE_DIR = "./epg-workspace/playlists"
+PLAYLIST_CACHE_MAX_AGE = 6 * 60 * 60  # 6 hours in seconds (then revalidate via ETag)
+GUIDE_TTL_FILE = "./epg-workspace/guide-ttl.json"
+SITE_INDEX_FILE = "./epg-workspace/site-index-{head}.json"  # Keyed by EPG repo git HEAD
+CACHE_TTL_JITTER = 0.2  # Spread cache expiry by +/-20% so scheduled runs don't all refresh together
 MAX_CONNECTIONS = 5  # Number of parallel EPG requests (increase for faster processing)
+PARALLEL_SITES = 4  # Number of sites grabbed at once (each with its own MAX_CONNECTIONS)
+GRAB_LOG_TAIL_LINES = 5  # Lines of a failed site's grab log shown in the summary
 EPG_DAYS = 1  # Number of days to fetch EPG data for (1-2 recommended)
 MAX_CHANNELS = 25  # Maximum number of channels to include (set to 0 for unlimited)
 
+# Shared connection pool for all HTTP downloads (playlists, revalidation)
+HTTP = urllib3.PoolManager(maxsize=20, headers={"User-Agent": "epg-generator/1.0"})
+
 # Reliable CDN domains (higher scores = more reliable)
 RELIABLE_DOMAINS = {
     "amagi.tv": 10,
@@ -51,14 +71,57 @@ PRIORITY_CHANNELS = [
 ]
 
 
+def jittered_ttl(max_age):
+    """Return max_age randomly scaled by +/-CACHE_TTL_JITTER"""
+    return max_age * random.uniform(1 - CACHE_TTL_JITTER, 1 + CACHE_TTL_JITTER)
+
+
 def run_command(cmd, cwd=None, check=True):
-    """Run shell command and return output"""
+    """Run a command given as an argv list (no shell) and return its output"""
     result = subprocess.run(
-        cmd, shell=True, cwd=cwd, capture_output=True, text=True, check=check
+        cmd, cwd=cwd, capture_output=True, text=True, check=check
     )
     return result.stdout
 
 
+def clone_epg_repo(epg_path):
+    """Shallow, sparse clone of the EPG repository (only EPG_SPARSE_DIRS checked out)"""
+    run_command(
+        ["git", "clone", "--depth=1", "--filter=blob:none", "--sparse", EPG_REPO, str(epg_path)]
+    )
+    run_command(["git", "-C", str(epg_path), "sparse-checkout", "set", "--cone", *EPG_SPARSE_DIRS])
+
+
+def update_epg_repo(epg_path):
+    """Move the shallow EPG checkout to the latest upstream commit"""
+    # A depth-1 history cannot prove a fast-forward, so `git pull --ff-only`
+    # fails on every new upstream commit; fetch the tip and reset onto it instead
+    run_command(["git", "fetch", "--depth=1", "origin"], cwd=epg_path)
+    run_command(["git", "reset", "--hard", "FETCH_HEAD"], cwd=epg_path)
+
+
+def install_dependencies(epg_path):
+    """Install npm dependencies unless node_modules matches package-lock.json.
+
+    Returns True if npm was run, False if the existing install was reused.
+    """
+    lock_path = epg_path / "package-lock.json"
+    marker_path = epg_path / NPM_LOCK_MARKER
+
+    if not lock_path.exists():
+        run_command(["npm", "install"], cwd=epg_path)
+        return True
+
+    lock_hash = hashlib.sha256(lock_path.read_bytes()).hexdigest()
+    if (epg_path / "node_modules").exists() and marker_path.exists():
+        if marker_path.read_text(encoding="utf-8").strip() == lock_hash:
+            return False
+
+    run_command(["npm", "ci"], cwd=epg_path)
+    marker_path.write_text(lock_hash + "\n", encoding="utf-8")
+    return True
+
+
 def read_urls_file():
     """Read URLs from the urls file. Returns empty list if file is missing or blank."""
     urls_path = Path(URLS_FILE)
@@ -68,12 +131,79 @@ def read_urls_file():
         return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
 
 
-def fetch_priority_streams_via_gh(priority_channels):
+def download_playlist(url, revalidate=False):
+    """Download an M3U playlist into the workspace.
+
+    A copy younger than its (jittered) PLAYLIST_CACHE_MAX_AGE is used as-is
+    unless revalidate is set. Older copies are revalidated with If-None-Match/If-Modified-Since, so an
+    unchanged playlist costs a 304 response instead of a full download.
+
+    Returns (local path, short status note). Nothing is printed here because
+    playlists are downloaded from worker threads.
+    """
+    cache_dir = Path(PLAYLIST_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Several playlists can share a basename (e.g. countries/us.m3u), so key by URL too
+    name = Path(urllib.parse.urlparse(url).path).stem or "playlist"
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+    playlist_path = cache_dir / f"{name}-{url_hash}.m3u"
+    meta_path = cache_dir / f"{name}-{url_hash}.json"
+
+    meta = {}
+    if playlist_path.exists() and meta_path.exists():
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+
+    if meta and not revalidate:
+        playlist_age = time.time() - meta.get("timestamp", 0)
+        if playlist_age < meta.get("ttl", PLAYLIST_CACHE_MAX_AGE):
+            return playlist_path, f"cached copy, {playlist_age / 3600:.1f} hours old"
+
+    # Passing headers replaces the pool defaults, so start from them
+    headers = dict(HTTP.headers)
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = HTTP.request("GET", url, headers=headers, preload_content=False)
+    try:
+        if response.status == 304 and meta:
+            status = "unchanged on server, cached copy"
+        elif response.status >= 300:
+            raise urllib3.exceptions.HTTPError(f"HTTP {response.status} for {url}")
+        else:
+            status = "downloaded"
+            tmp_path = playlist_path.with_suffix(".m3u.tmp")
+            with open(tmp_path, "wb") as f:
+                for chunk in response.stream(64 * 1024):
+                    f.write(chunk)
+            os.replace(tmp_path, playlist_path)
+            meta = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+    finally:
+        response.release_conn()
+
+    meta["timestamp"] = time.time()
+    meta["ttl"] = jittered_ttl(PLAYLIST_CACHE_MAX_AGE)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    return playlist_path, status
+
+
+def fetch_priority_streams_via_gh(priority_channels, revalidate=False):
     """Fetch M3U streams for priority channels from iptv-org/iptv via gh CLI.
 
     Lists all stream files matching each country prefix derived from channel IDs
     (e.g. CSPAN.us → us.m3u, us_tvpass.m3u, us_amagi.m3u, ...) and filters to
-    matching channels.
+    matching channels. revalidate is passed on to download_playlist.
     """
     # Derive country prefixes from channel ID suffixes
     # Strip @variant first: "CSPAN.us@SD" → "CSPAN.us" → prefix "us"
@@ -87,11 +217,17 @@ def fetch_priority_streams_via_gh(priority_channels):
         return []
 
     # List all stream files and filter to those matching our prefixes
-    listing = run_command(
-        "gh api repos/iptv-org/iptv/contents/streams"
-        " --jq '[.[] | {name: .name, download_url: .download_url}]'",
-        check=False,
-    ).strip()
+    try:
+        listing = run_command(
+            [
+                "gh", "api", "repos/iptv-org/iptv/contents/streams",
+                "--jq", "[.[] | {name: .name, download_url: .download_url}]",
+            ],
+            check=False,
+        ).strip()
+    except OSError:
+        # gh CLI not installed
+        listing = ""
     if not listing:
         print("ERROR: Could not list iptv-org/iptv/streams via gh")
         return []
@@ -113,12 +249,12 @@ def fetch_priority_streams_via_gh(priority_channels):
 
     for f in country_files:
         try:
-            with urllib.request.urlopen(f["download_url"]) as resp:
-                content = resp.read().decode("utf-8")
-            matched = [
-                ch for ch in parse_m3u(content)
-                if (ch.get("tvg_id") or "").lower() in priority_ids
-            ]
+            playlist_path, _ = download_playlist(f["download_url"], revalidate)
+            with open(playlist_path, "r", encoding="utf-8") as playlist_file:
+                matched = [
+                    ch for ch in iter_channels(playlist_file)
+                    if (ch.get("tvg_id") or "").lower() in priority_ids
+                ]
             if matched:
                 print(f"  ✓ {f['name']}: {len(matched)} priority stream(s)")
                 all_channels.extend(matched)
@@ -174,88 +310,171 @@ def calculate_reliability_score(channel):
     return score
 
 
-def parse_m3u(m3u_content):
-    """Parse M3U content and extract channel entries with metadata"""
-    channels = []
-    lines = m3u_content.split("\n")
+def extract_tvg_id(extinf_line):
+    """Return the tvg-id attribute of an #EXTINF line, or None if absent/empty"""
+    start = extinf_line.find('tvg-id="')
+    if start == -1:
+        return None
+    start += len('tvg-id="')
+    end = extinf_line.find('"', start)
+    if end == -1:
+        return None
+    return extinf_line[start:end] or None
 
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
 
-        # Look for #EXTINF lines
+def iter_channels(m3u_lines):
+    """Parse an iterable of M3U lines, yielding channel entries with metadata"""
+    metadata_lines = None
+
+    for line in m3u_lines:
+        line = line.strip()
+        if not line:
+            continue
+
         if line.startswith("#EXTINF:"):
-            # Collect all metadata lines for this channel
+            # Start a new channel; an unterminated previous entry is dropped
             metadata_lines = [line]
-            i += 1
+        elif line.startswith("#"):
+            # Additional metadata lines (like #EXTVLCOPT)
+            if metadata_lines is not None:
+                metadata_lines.append(line)
+        elif metadata_lines is not None:
+            # First non-comment line after #EXTINF is the stream URL
+            yield {
+                "tvg_id": extract_tvg_id(metadata_lines[0]),
+                "metadata_lines": metadata_lines,
+                "stream_url": line,
+            }
+            metadata_lines = None
+
+
+def iter_playlist_channels(playlist_downloads):
+    """Yield channels from (url, download future) pairs in order, as they are parsed"""
+    for idx, (m3u_url, download) in enumerate(playlist_downloads, 1):
+        print(f"  [{idx}/{len(playlist_downloads)}] {m3u_url}")
+        try:
+            playlist_path, status = download.result()
+        except Exception as e:
+            print(f"       ERROR: Failed to download playlist: {e}")
+            continue
+
+        playlist_count = 0
+        try:
+            with open(playlist_path, "r", encoding="utf-8") as playlist_file:
+                for channel in iter_channels(playlist_file):
+                    playlist_count += 1
+                    yield channel
+        except Exception as e:
+            # Channels already yielded stay matched; skip the rest of this playlist
+            print(f"       ERROR: Failed to read playlist: {e}")
+            continue
+        print(f"       Found {playlist_count} channels ({status})")
+
+
+def channel_entry(channel):
+    """Reduce a site <channel> element to a lightweight (attributes, name) tuple"""
+    return dict(channel.attrib), channel.text
+
+
+def make_channel_element(entry):
+    """Build a fresh <channel> element from a (attributes, name) tuple"""
+    attributes, name = entry
+    channel = ET.Element("channel", attributes)
+    channel.text = name
+    return channel
 
-            # Get any additional metadata lines (like #EXTVLCOPT)
-            while (
-                i < len(lines)
-                and lines[i].strip().startswith("#")
-                and not lines[i].strip().startswith("#EXTINF:")
-            ):
-                metadata_lines.append(lines[i].strip())
-                i += 1
 
-            # Next non-empty line should be the stream URL
-            while i < len(lines) and not lines[i].strip():
-                i += 1
+def parse_site_channels(site_channels_file):
+    """Parse one site channel configuration into (xmltv_id, entry) pairs"""
+    pairs = []
+    try:
+        for _, channel in ET.iterparse(
+            str(site_channels_file), events=("end",), tag="channel"
+        ):
+            xmltv_id = channel.get("xmltv_id")
+            if xmltv_id:
+                pairs.append((xmltv_id, channel_entry(channel)))
+            channel.clear()
+    except ET.ParseError:
+        return []
+    except Exception:
+        return []
 
-            if i < len(lines):
-                stream_url = lines[i].strip()
+    return pairs
 
-                # Extract tvg-id if present
-                tvg_id_match = re.search(r'tvg-id="([^"]+)"', metadata_lines[0])
-                tvg_id = tvg_id_match.group(1) if tvg_id_match else None
 
-                channels.append(
-                    {
-                        "tvg_id": tvg_id,
-                        "metadata_lines": metadata_lines,
-                        "stream_url": stream_url,
-                        "full_entry": "\n".join(metadata_lines) + "\n" + stream_url,
-                    }
-                )
+def build_site_index(sites_dir):
+    """Index all site channel configurations by xmltv_id (first match wins)"""
+    site_files = list(Path(sites_dir).glob("*/*.channels.xml"))
+    index = {}
 
-        i += 1
+    # lxml releases the GIL while parsing, so threads parse files concurrently
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for pairs in executor.map(parse_site_channels, site_files):
+            for xmltv_id, entry in pairs:
+                index.setdefault(xmltv_id, entry)
 
-    return channels
+    return index
 
 
-def find_channel_in_sites(tvg_id, sites_dir):
-    """Search for a channel across all site configurations"""
-    sites_path = Path(sites_dir)
+def load_site_index(epg_path, sites_dir):
+    """Load the site index cached for the EPG repo's current HEAD, or build and cache it.
 
-    for site_channels_file in sites_path.glob("*/*.channels.xml"):
+    The index only changes when the EPG repository does, so it is invalidated by
+    git HEAD rather than by age. Returns (index, True if loaded from cache).
+    """
+    try:
+        head = run_command(["git", "rev-parse", "HEAD"], cwd=epg_path).strip()
+    except (OSError, subprocess.CalledProcessError):
+        head = ""
+    if not head:
+        return build_site_index(sites_dir), False
+
+    index_path = Path(SITE_INDEX_FILE.format(head=head))
+    if index_path.exists():
         try:
-            tree = ET.parse(site_channels_file)
-            root = tree.getroot()
+            with open(index_path, "r", encoding="utf-8") as f:
+                return json.load(f), True
+        except (OSError, ValueError):
+            pass
 
-            # Find channel with matching xmltv_id
-            for channel in root.findall(".//channel[@xmltv_id='{}']".format(tvg_id)):
-                return channel
-        except ET.ParseError:
-            continue
-        except Exception:
-            continue
+    index = build_site_index(sites_dir)
 
-    return None
+    # Indexes for older HEADs can never be hit again
+    for stale_path in index_path.parent.glob(Path(SITE_INDEX_FILE.format(head="*")).name):
+        if stale_path != index_path:
+            stale_path.unlink()
+
+    tmp_path = index_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, separators=(",", ":"), ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+
+    return index, False
 
 
 def save_channel_cache(matched_channels, channels_root):
-    """Save matched channels and XML tree to cache file"""
+    """Save matched channels (one JSON object per line) and XML tree to cache files"""
     cache_data = {
         "timestamp": time.time(),
-        "matched_channels": matched_channels,
-        "channels_xml": ET.tostring(channels_root, encoding="unicode"),
+        "ttl": jittered_ttl(CACHE_MAX_AGE),
     }
 
     cache_path = Path(CACHE_FILE)
     cache_path.parent.mkdir(exist_ok=True)
 
+    ET.ElementTree(channels_root).write(
+        CACHE_CHANNELS_FILE, encoding="utf-8", xml_declaration=True
+    )
+
+    with open(CACHE_MATCHES_FILE, "w", encoding="utf-8") as f:
+        for channel in matched_channels:
+            f.write(json.dumps(channel, separators=(",", ":"), ensure_ascii=False))
+            f.write("\n")
+
     with open(cache_path, "w", encoding="utf-8") as f:
-        json.dump(cache_data, f, indent=2)
+        json.dump(cache_data, f, separators=(",", ":"), ensure_ascii=False)
 
     print(f"Channel cache saved to: {cache_path}")
 
@@ -273,17 +492,19 @@ def load_channel_cache():
 
         cache_age = time.time() - cache_data["timestamp"]
 
-        if cache_age > CACHE_MAX_AGE:
+        if cache_age > cache_data.get("ttl", CACHE_MAX_AGE):
             print(f"Cache is {cache_age / 3600:.1f} hours old, refreshing...")
             return None
 
         print(f"Loaded channel cache ({cache_age / 3600:.1f} hours old)")
 
-        # Reconstruct channels_root from XML string
-        channels_root = ET.fromstring(cache_data["channels_xml"])
+        with open(CACHE_MATCHES_FILE, "r", encoding="utf-8") as f:
+            matched_channels = [json.loads(line) for line in f if line.strip()]
+
+        channels_root = ET.parse(CACHE_CHANNELS_FILE).getroot()
 
         return {
-            "matched_channels": cache_data["matched_channels"],
+            "matched_channels": matched_channels,
             "channels_root": channels_root,
         }
 
@@ -292,6 +513,115 @@ def load_channel_cache():
         return None
 
 
+def group_channels_by_site(channels_root):
+    """Group <channel> elements by their site attribute, preserving order"""
+    site_groups = {}
+    for channel in channels_root:
+        site_groups.setdefault(channel.get("site") or "unknown", []).append(channel)
+    return site_groups
+
+
+def grab_site_epg(site, site_channels, epg_path, max_connections, days, env):
+    """Run epg-grabber for one site's channels and return the guide file it wrote.
+
+    Grabber output goes to grab-<site>.log, which is removed on success. On
+    failure the log is kept and its last lines are attached to the raised
+    CalledProcessError as output.
+    """
+    safe_site = "".join(c if c.isalnum() or c in "-._" else "_" for c in site)
+    channels_name = f"channels-{safe_site}.xml"
+    guide_name = f"guide-{safe_site}.xml"
+
+    channels_file = epg_path / channels_name
+    log_file = epg_path / f"grab-{safe_site}.log"
+
+    channels_root = ET.Element("channels")
+    channels_root.extend(make_channel_element(channel_entry(ch)) for ch in site_channels)
+    tree = ET.ElementTree(channels_root)
+    ET.indent(tree, space="  ")
+    tree.write(str(channels_file), encoding="utf-8", xml_declaration=True)
+
+    grab_cmd = [
+        "npm", "run", "grab", "--",
+        f"--channels={channels_name}",
+        f"--output={guide_name}",
+        f"--maxConnections={max_connections}",
+        f"--days={days}",
+    ]
+
+    # Several grabs run at once and would interleave on the terminal, so each
+    # writes to its own log (follow progress with tail -f)
+    try:
+        with open(log_file, "w", encoding="utf-8") as log:
+            subprocess.run(
+                grab_cmd, cwd=epg_path, check=True, env=env,
+                stdout=log, stderr=subprocess.STDOUT,
+            )
+    except subprocess.CalledProcessError as e:
+        with open(log_file, "r", encoding="utf-8", errors="replace") as log:
+            tail = collections.deque(log, maxlen=GRAB_LOG_TAIL_LINES)
+        e.output = "".join(tail) + f"(full log: {log_file})"
+        raise
+    except OSError:
+        # npm could not be started, so the log is empty
+        log_file.unlink(missing_ok=True)
+        raise
+    finally:
+        # Untracked files survive the repo update, so don't let them pile up
+        channels_file.unlink(missing_ok=True)
+
+    log_file.unlink()
+    return epg_path / guide_name
+
+
+def merge_guides(guide_files, output_path):
+    """Merge XMLTV guides into one file, all <channel> elements before <programme>s"""
+    merged = None
+    channels = []
+    programmes = []
+
+    for guide_file in guide_files:
+        root = ET.parse(str(guide_file)).getroot()
+        if merged is None:
+            merged = ET.Element(root.tag, dict(root.attrib))
+        for element in root:
+            if element.tag == "channel":
+                channels.append(element)
+            elif element.tag == "programme":
+                programmes.append(element)
+
+    merged.extend(channels)
+    merged.extend(programmes)
+    ET.ElementTree(merged).write(str(output_path), encoding="utf-8", xml_declaration=True)
+
+
+def publish_guide(guide_path, output_guide_path):
+    """Move the generated guide into place atomically so readers never see a partial file"""
+    # Same filesystem: both steps are renames. Otherwise shutil.move copies
+    # into the temp file next to the output, and only the final rename is visible.
+    tmp_path = output_guide_path.with_suffix(".xml.tmp")
+    shutil.move(str(guide_path), str(tmp_path))
+    os.replace(tmp_path, output_guide_path)
+
+
+def save_guide_ttl():
+    """Record a jittered max age for the guide.xml that was just generated"""
+    ttl_path = Path(GUIDE_TTL_FILE)
+    ttl_path.parent.mkdir(exist_ok=True)
+
+    with open(ttl_path, "w", encoding="utf-8") as f:
+        json.dump({"ttl": jittered_ttl(GUIDE_CACHE_MAX_AGE)}, f)
+
+
+def load_guide_ttl():
+    """Load the max age recorded for guide.xml, falling back to GUIDE_CACHE_MAX_AGE"""
+    try:
+        with open(GUIDE_TTL_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)["ttl"]
+    except (OSError, ValueError, KeyError):
+        return GUIDE_CACHE_MAX_AGE
+
+
 def is_guide_recent():
     """Check if guide.xml exists and is recent enough"""
     guide_path = Path(OUTPUT_GUIDE)
@@ -301,7 +631,7 @@ def is_guide_recent():
 
     guide_age = time.time() - guide_path.stat().st_mtime
 
-    if guide_age > GUIDE_CACHE_MAX_AGE:
+    if guide_age > load_guide_ttl():
         print(
             f"Existing guide.xml is {guide_age / 3600:.1f} hours old, regenerating..."
         )
@@ -317,7 +647,7 @@ def main():
     parser.add_argument(
         "--refresh",
         action="store_true",
-        help="Force refresh channel cache (ignore existing cache)",
+        help="Force refresh channel cache (ignore existing cache, revalidate playlists)",
     )
     parser.add_argument(
         "--refresh-epg",
@@ -330,6 +660,12 @@ def main():
         default=MAX_CONNECTIONS,
         help=f"Number of parallel EPG requests (default: {MAX_CONNECTIONS})",
     )
+    parser.add_argument(
+        "--parallel-sites",
+        type=int,
+        default=PARALLEL_SITES,
+        help=f"Number of sites to grab EPG data from at once (default: {PARALLEL_SITES})",
+    )
     parser.add_argument(
         "--days",
         type=int,
@@ -347,6 +683,11 @@ def main():
         action="store_true",
         help="Include only PRIORITY_CHANNELS in output",
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print the match result for every channel",
+    )
     args = parser.parse_args()
 
     print("=== Jellyfin IPTV EPG Generator ===\n")
@@ -357,86 +698,112 @@ def main():
     work_path.mkdir(exist_ok=True)
     epg_path = work_path / "epg"
 
-    # Clone or update EPG repository
-    if not epg_path.exists():
-        print("[2/6] Cloning EPG repository...")
-        run_command(f"git clone {EPG_REPO} {epg_path}")
-    else:
-        print("[2/6] Updating EPG repository...")
-        run_command("git pull", cwd=epg_path)
-
-    # Install dependencies
-    print("[3/6] Installing dependencies...")
-    run_command("npm install", cwd=epg_path)
-
     sites_dir = epg_path / "sites"
 
     # Try to load from cache
     cache = None if args.refresh else load_channel_cache()
 
+    m3u_urls = []
+    if not cache and not args.priority_only:
+        m3u_urls = read_urls_file()
+        if not m3u_urls:
+            print(f"ERROR: No URLs found in {URLS_FILE}")
+            sys.exit(1)
+        print(f"Found {len(m3u_urls)} playlist URL(s) in {URLS_FILE}")
+
+    # Playlist downloads overlap the repository update; npm install and the
+    # site index build only need the updated checkout, so they overlap too
+    with ThreadPoolExecutor(max_workers=len(m3u_urls) + 3) as executor:
+        # Clone or update EPG repository
+        if not epg_path.exists():
+            print("[2/6] Cloning EPG repository...")
+            repo_update = executor.submit(clone_epg_repo, epg_path)
+        else:
+            print("[2/6] Updating EPG repository...")
+            repo_update = executor.submit(update_epg_repo, epg_path)
+
+        playlist_downloads = [
+            (m3u_url, executor.submit(download_playlist, m3u_url, args.refresh))
+            for m3u_url in m3u_urls
+        ]
+        if playlist_downloads:
+            print(f"       Downloading {len(playlist_downloads)} M3U playlist(s) meanwhile...")
+
+        repo_update.result()
+
+        # Install dependencies
+        print("[3/6] Installing dependencies...")
+        npm_install = executor.submit(install_dependencies, epg_path)
+        site_index_build = None
+        if not cache:
+            print("       Indexing EPG site configurations meanwhile...")
+            site_index_build = executor.submit(load_site_index, epg_path, sites_dir)
+
+        if not npm_install.result():
+            print("       node_modules matches package-lock.json, skipped npm ci")
+        site_index = None
+        if site_index_build:
+            site_index, site_index_cached = site_index_build.result()
+            if site_index_cached:
+                print("       EPG repository unchanged, reused cached site index")
+
     if cache:
         print("[4/6] Using cached M3U playlist data")
         print("[5/6] Using cached channel matching results\n")
         matched_channels = cache["matched_channels"]
         channels_root = cache["channels_root"]
         matched_count = len(matched_channels)
+
+        # The cached channels.xml already holds every matched site channel
+        site_index = {}
+        for channel_element in channels_root:
+            site_index.setdefault(
+                channel_element.get("xmltv_id"), channel_entry(channel_element)
+            )
     else:
-        print("[4/6] Downloading M3U playlists...")
+        print("[4/6] Loading M3U playlists...")
         if args.priority_only:
             print("--priority-only: fetching streams from iptv-org/iptv via gh (ignoring urls file)...")
-            all_channels = fetch_priority_streams_via_gh(PRIORITY_CHANNELS)
+            channels = fetch_priority_streams_via_gh(PRIORITY_CHANNELS, args.refresh)
         else:
-            m3u_urls = read_urls_file()
-            if not m3u_urls:
-                print(f"ERROR: No URLs found in {URLS_FILE}")
-                sys.exit(1)
-            print(f"Found {len(m3u_urls)} playlist URL(s) in {URLS_FILE}")
-
-            all_channels = []
-            for idx, m3u_url in enumerate(m3u_urls, 1):
-                print(f"  [{idx}/{len(m3u_urls)}] Downloading {m3u_url}...")
-                try:
-                    with urllib.request.urlopen(m3u_url) as response:
-                        m3u_content = response.read().decode("utf-8")
-
-                    playlist_channels = parse_m3u(m3u_content)
-                    all_channels.extend(playlist_channels)
-                    print(f"       Found {len(playlist_channels)} channels")
-                except Exception as e:
-                    print(f"       ERROR: Failed to download playlist: {e}")
-                    continue
-
-        channels = all_channels
-        total_channels = len(channels)
-        print(f"\nTotal: {total_channels} channels from all playlists\n")
+            # Playlists are parsed lazily and matched as they are read
+            channels = iter_playlist_channels(playlist_downloads)
 
         # Match channels with EPG sources
         print("[5/6] Matching channels with EPG sources and filtering playlist...")
+        print(f"Indexed {len(site_index)} channels from EPG site configurations")
 
         channels_root = ET.Element("channels")
         matched_channels = []
         matched_count = 0
         skipped_count = 0
+        total_channels = 0
 
         for channel in channels:
+            total_channels += 1
             tvg_id = channel["tvg_id"]
 
             if not tvg_id:
-                print(f"  ⊘ Skipped: No tvg-id in channel")
+                if args.verbose:
+                    print(f"  ⊘ Skipped: No tvg-id in channel")
                 skipped_count += 1
-                continue
-
-            channel_element = find_channel_in_sites(tvg_id, sites_dir)
-
-            if channel_element is not None:
-                channels_root.append(channel_element)
-                matched_channels.append(channel)
-                matched_count += 1
-                print(f"  ✓ Matched: {tvg_id}")
             else:
-                print(f"  ✗ Removed: {tvg_id} (no EPG source)")
-
-        print(f"\nMatched {matched_count}/{total_channels} channels with EPG sources")
+                site_channel = site_index.get(tvg_id)
+
+                if site_channel is not None:
+                    channels_root.append(make_channel_element(site_channel))
+                    matched_channels.append(channel)
+                    matched_count += 1
+                    if args.verbose:
+                        print(f"  ✓ Matched: {tvg_id}")
+                elif args.verbose:
+                    print(f"  ✗ Removed: {tvg_id} (no EPG source)")
+
+            if not args.verbose and total_channels % 100 == 0:
+                print(f"  matched {matched_count}/{total_channels}")
+
+        print(f"\nTotal: {total_channels} channels from all playlists")
+        print(f"Matched {matched_count}/{total_channels} channels with EPG sources")
         print(f"Skipped {skipped_count} channels without tvg-id")
         print(
             f"Removed {total_channels - matched_count - skipped_count} channels without EPG\n"
@@ -455,9 +822,9 @@ def main():
         matched_channels = priority_matched
         channels_root = ET.Element("channels")
         for channel in matched_channels:
-            channel_element = find_channel_in_sites(channel["tvg_id"], sites_dir)
-            if channel_element is not None:
-                channels_root.append(channel_element)
+            site_channel = site_index.get(channel["tvg_id"])
+            if site_channel is not None:
+                channels_root.append(make_channel_element(site_channel))
         matched_count = len(matched_channels)
 
     # Filter to most reliable channels if max_channels is set (skip when priority_only)
@@ -484,9 +851,9 @@ def main():
         matched_channels = top_channels
         channels_root = ET.Element("channels")
         for channel in matched_channels:
-            channel_element = find_channel_in_sites(channel["tvg_id"], sites_dir)
-            if channel_element is not None:
-                channels_root.append(channel_element)
+            site_channel = site_index.get(channel["tvg_id"])
+            if site_channel is not None:
+                channels_root.append(make_channel_element(site_channel))
 
         matched_count = len(matched_channels)
         print(f"\nFiltered to {matched_count} channels\n")
@@ -499,19 +866,22 @@ def main():
         print("The EPG repository may not have sources for these channels.")
         sys.exit(1)
 
-    # Write channels.xml
+    # Write channels.xml (not read by the per-site grabs; kept as a record of
+    # the matched channels for this run)
     channels_file = epg_path / "channels.xml"
     tree = ET.ElementTree(channels_root)
     ET.indent(tree, space="  ")
-    tree.write(channels_file, encoding="utf-8", xml_declaration=True)
+    tree.write(str(channels_file), encoding="utf-8", xml_declaration=True)
 
     # Write filtered M3U playlist
     print("Writing filtered M3U playlist...")
     filtered_playlist_path = Path(OUTPUT_PLAYLIST).resolve()
-    with open(filtered_playlist_path, "w", encoding="utf-8") as f:
+    with open(filtered_playlist_path, "w", encoding="utf-8", buffering=1 << 20) as f:
         f.write("#EXTM3U\n")
-        for channel in matched_channels:
-            f.write(channel["full_entry"] + "\n")
+        f.writelines(
+            "\n".join(channel["metadata_lines"]) + "\n" + channel["stream_url"] + "\n"
+            for channel in matched_channels
+        )
 
     print(f"Filtered playlist saved: {filtered_playlist_path}")
     print(f"Contains {len(matched_channels)} channels with EPG data\n")
@@ -527,9 +897,13 @@ def main():
 
     # Generate EPG
     print("[6/6] Generating EPG data...")
+    site_groups = group_channels_by_site(channels_root)
+    parallel_sites = max(1, args.parallel_sites)
     print(
-        f"Settings: {args.max_connections} parallel connections, {args.days} day(s) of data"
+        f"Settings: {len(site_groups)} site(s), {parallel_sites} at a time, "
+        f"{args.max_connections} parallel connections each, {args.days} day(s) of data"
     )
+    print(f"Per-site progress: {epg_path / 'grab-<site>.log'}")
     print("This may take several minutes...\n")
 
     try:
@@ -537,28 +911,64 @@ def main():
         env = os.environ.copy()
         env["NODE_OPTIONS"] = "--max-old-space-size=8192"
 
-        # Build command with optimization options
-        grab_cmd = (
-            f"npm run grab -- "
-            f"--channels=channels.xml "
-            f"--output=guide.xml "
-            f"--maxConnections={args.max_connections} "
-            f"--days={args.days}"
-        )
-
-        print(f"Running: {grab_cmd}\n")
-
-        # Run without capturing output so we can see progress in real-time
-        result = subprocess.run(grab_cmd, shell=True, cwd=epg_path, check=True, env=env)
+        # Each site has its own rate limits, so grab sites in separate processes
+        # and let slow sites run alongside fast ones
+        site_guides = {}
+        grab_errors = []
+        with ThreadPoolExecutor(max_workers=parallel_sites) as executor:
+            grabs = {
+                executor.submit(
+                    grab_site_epg, site, site_channels, epg_path,
+                    args.max_connections, args.days, env,
+                ): site
+                for site, site_channels in site_groups.items()
+            }
+            for grab in as_completed(grabs):
+                site = grabs[grab]
+                try:
+                    site_guide = grab.result()
+                except subprocess.CalledProcessError as e:
+                    grab_errors.append(e)
+                    print(f"  ✗ {site}: epg-grabber exited with code {e.returncode}")
+                    for line in (e.output or "").strip().splitlines():
+                        print(f"      {line}")
+                    continue
+                except OSError as e:
+                    # npm not installed; report it like the shell's "not found" (127)
+                    grab_errors.append(subprocess.CalledProcessError(127, "npm run grab"))
+                    print(f"  ✗ {site}: could not run npm: {e}")
+                    continue
 
-        # Copy output
-        output_guide_path = Path(OUTPUT_GUIDE).resolve()
+                if site_guide.exists():
+                    site_guides[site] = site_guide
+                    print(f"  ✓ {site} ({len(site_groups[site])} channels)")
+                else:
+                    print(f"  ✗ {site}: epg-grabber did not write {site_guide.name}")
+
+        # Some sites may fail to scrape; still publish a guide for the rest
+        failed_count = len(site_groups) - len(site_guides)
+        if not site_guides and grab_errors:
+            raise grab_errors[0]
+        if failed_count and site_guides:
+            print(f"\n{failed_count} site(s) failed, continuing with the rest")
+
+        # Merge in site order so the guide is stable between runs
+        guide_files = [site_guides[site] for site in site_groups if site in site_guides]
         guide_path = epg_path / "guide.xml"
+        # Only merge_guides may produce guide.xml now; drop any copy left by
+        # older versions so it can never be published as this run's guide
+        guide_path.unlink(missing_ok=True)
+        if guide_files:
+            merge_guides(guide_files, guide_path)
+            for guide_file in guide_files:
+                guide_file.unlink()
+
+        # Publish output
+        output_guide_path = Path(OUTPUT_GUIDE).resolve()
 
-        if guide_path.exists():
-            import shutil
-
-            shutil.copy(guide_path, output_guide_path)
+        if guide_files:
+            publish_guide(guide_path, output_guide_path)
+            save_guide_ttl()
 
             print("\n=== SUCCESS ===")
             print(f"EPG guide generated: {output_guide_path}")
@@ -578,8 +988,9 @@ def main():
             print(
                 f"  - Increase speed: --max-connections=10 (current: {args.max_connections})"
             )
+            print(f"  - Grab more sites at once: --parallel-sites=8 (current: {parallel_sites})")
             print(f"  - Reduce data: --days=1 (current: {args.days})")
-            print(f"  - Skip if recent: guide regenerates only if >12h old")
+            print(f"  - Skip if recent: guide regenerates only if >~12h old")
         else:
             print("\n=== ERROR ===")
             print("EPG generation completed but guide.xml was not created.")